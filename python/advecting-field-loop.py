@@ -8,22 +8,16 @@
 """
 
 from timeit import default_timer
-import matplotlib
-import matplotlib.pyplot as plt
+import concurrent.futures
+import functools
 import numpy as np
 import argparse
 import pathlib
 import scipy
+import numba
 
 import shared_tools
 
-plt.close('all')
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
 # Values to loop over
 resolutions   = [32, 64, 128, 256]
 reconstructor = 'ppmc'
@@ -37,6 +31,9 @@ radius        = 0.3
 save_path = shared_tools.repo_root / 'python' / 'afl.pkl'
 save_path_slice  = shared_tools.repo_root / 'python' / 'afl_slice.pkl'
 
+# The initial and final files used for the slice plots
+slice_file_names = ['afl_n256_0', 'afl_n256_10']
+
 # ==============================================================================
 def main():
     # Check for CLI arguments
@@ -44,10 +41,12 @@ def main():
     parser.add_argument('-p', '--in_path', help='The path to the directory that the source files are located in. Defaults to "~/Code/cholla/bin"')
     parser.add_argument('-o', '--out_path', help='The path of the directory to write the plots out to. Defaults to writing in the same directory as the input files')
     parser.add_argument('-r', '--run_cholla', action="store_true", help='Runs cholla to generate all the data')
+    parser.add_argument('-j', '--jobs', type=int, help='The maximum number of Cholla runs to perform concurrently. Defaults to one per resolution, limited by the number of CPUs')
     parser.add_argument('-f', '--figure', action="store_true", help='Generate the plots')
     parser.add_argument('-d', '--data', action="store_true", help='Load and generate the data to be plotted.')
     parser.add_argument('--slicedata', action="store_true", help='Load and generate the slice data to be plotted.')
     parser.add_argument('--slicefigure', action="store_true", help='Plot the slice figure')
+    parser.add_argument('--force', action="store_true", help='Regenerate the data and slice data even if they are newer than the Cholla output')
 
     args = parser.parse_args()
 
@@ -62,17 +61,21 @@ def main():
         OutPath = pathlib.Path(__file__).resolve().parent.parent / 'latex-src'
 
     if args.run_cholla:
-        runCholla()
+        runCholla(args.jobs)
 
     if args.data:
-        shared_tools.pickle_dictionary(load_data(), save_path)
+        data_files = shared_tools.data_files_path.glob('afl_n*_*.h5')
+        if args.force or not shared_tools.is_up_to_date(save_path, data_files):
+            shared_tools.pickle_dictionary(load_data(), save_path)
 
     if args.figure:
         plotAFL(OutPath)
         shared_tools.update_plot_entry("afl", 'python/advecting-field-loop.py')
 
     if args.slicedata:
-        shared_tools.pickle_dictionary(load_slices(), save_path_slice)
+        slice_files = [shared_tools.data_files_path / f'{file_name}.h5' for file_name in slice_file_names]
+        if args.force or not shared_tools.is_up_to_date(save_path_slice, slice_files):
+            shared_tools.pickle_dictionary(load_slices(), save_path_slice)
 
     if args.slicefigure:
         plotAFL_slice(OutPath)
@@ -81,92 +84,188 @@ def main():
 # ==============================================================================
 
 # ==============================================================================
-def runCholla():
-    for res in resolutions:
-        run_start = default_timer()
-
-        cli_args = f'nx={res} ny={res} nz={2*res} tout={tout} outstep={outstep} A={B_0} radius={radius}'
-        shared_tools.cholla_runner(reconstructor=reconstructor,
-                                   param_file_name=f'advecting_field_loop.txt',
-                                   cholla_cli_args=cli_args,
-                                   move_initial=True,
-                                   move_final=True,
-                                   initial_filename=f'afl_n{res}_0',
-                                   final_filename=f'afl_n{res}_1')
-        # Copy the rest of the data
-        files = (shared_tools.repo_root/'python').glob('*.h5.*')
-        for target in files:
-            target.rename(shared_tools.data_files_path / f'afl_n{res}_{target.stem}')
-
-        print(f'Finished with N={res} run. Time {round(default_timer()-run_start,2)}s')
-# ==============================================================================
+def runCholla(max_workers=None):
+    # Each resolution is an independent run so launch them concurrently
+    max_workers = shared_tools.max_concurrent_workers(len(resolutions), max_workers)
 
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_single_resolution, resolutions))
 # ==============================================================================
-def load_data():
-    b_squared_avg = {}
-    divergence    = {}
-    times         = {}
-    for res in resolutions:
-        key = f'{res}'
-
-        b_squared_avg[key] = np.zeros(num_outputs)
-        divergence[key]    = np.zeros(num_outputs)
-        times[key]         = np.zeros(num_outputs)
 
-        for i in range(num_outputs):
-            file_name = f'afl_n{res}_{i}'
-
-            temp_data = shared_tools.load_conserved_data(file_name, load_time=True, load_dx=True)
-            temp_data = shared_tools.center_magnetic_fields(temp_data)
-
-            b_squared_avg[key][i] = np.mean(temp_data['magnetic_x_centered']**2
-                                    + temp_data['magnetic_y_centered']**2
-                                    + temp_data['magnetic_z_centered']**2)
-
-            div_x = (temp_data['magnetic_x'][1:, :, :]
-                   - temp_data['magnetic_x'][:-1, :, :]) / temp_data['dx'][0]
-            div_y = (temp_data['magnetic_y'][:, 1:, :]
-                   - temp_data['magnetic_y'][:, :-1, :]) / temp_data['dx'][1]
-            div_z = (temp_data['magnetic_z'][:, :, 1:]
-                   - temp_data['magnetic_z'][:, :, :-1]) / temp_data['dx'][2]
-            divergence[key][i] = np.max(div_x + div_y + div_z)
-
-            times[key][i] = temp_data['time']
+# ==============================================================================
+def run_single_resolution(res):
+    run_start = default_timer()
+
+    cli_args = f'nx={res} ny={res} nz={2*res} tout={tout} outstep={outstep} A={B_0} radius={radius}'
+    shared_tools.cholla_runner(reconstructor=reconstructor,
+                               param_file_name=f'advecting_field_loop.txt',
+                               cholla_cli_args=cli_args,
+                               move_initial=True,
+                               move_final=True,
+                               initial_filename=f'afl_n{res}_0',
+                               final_filename=f'afl_n{res}_1',
+                               snapshot_prefix=f'afl_n{res}')
+
+    print(f'Finished with N={res} run. Time {round(default_timer()-run_start,2)}s')
+# ==============================================================================
 
-        b_squared_avg[key] /= b_squared_avg[key][0]
+# ==============================================================================
+def load_data():
+    # Each row is a resolution and each column an output
+    b_squared_avg = np.zeros((len(resolutions), num_outputs))
+    divergence    = np.zeros((len(resolutions), num_outputs))
+    times         = np.zeros((len(resolutions), num_outputs))
+    for res_idx, res in enumerate(resolutions):
+        # Allocate the magnetic field buffers once per resolution and reuse them
+        # for every snapshot. These stay in double precision since the
+        # divergence should sit at double precision roundoff. There are two
+        # sets of buffers so that the next snapshot can be read while the
+        # current one is reduced
+        buffers = [{'magnetic_x':np.empty((res+1, res, 2*res)),
+                    'magnetic_y':np.empty((res, res+1, 2*res)),
+                    'magnetic_z':np.empty((res, res, 2*res+1))} for _ in range(2)]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            next_snapshot = executor.submit(shared_tools.load_magnetic_data, f'afl_n{res}_0', buffers=buffers[0])
+
+            for i in range(num_outputs):
+                temp_data = next_snapshot.result()
+
+                # Start reading the next snapshot
+                if i + 1 < num_outputs:
+                    next_snapshot = executor.submit(shared_tools.load_magnetic_data,
+                                                    f'afl_n{res}_{i+1}',
+                                                    buffers=buffers[(i+1) % 2])
+
+                b_squared_avg[res_idx, i], divergence[res_idx, i] = reduce_snapshot(temp_data['magnetic_x'],
+                                                                                    temp_data['magnetic_y'],
+                                                                                    temp_data['magnetic_z'],
+                                                                                    temp_data['dx'])
+
+                times[res_idx, i] = temp_data['time']
+
+    b_squared_avg /= b_squared_avg[:, 0:1]
 
     return {'b_squared_avg':b_squared_avg, 'divergence':divergence, 'times':times}
 # ==============================================================================
 
+# ==============================================================================
+# fastmath is left off so that reassociating the differences can't change the
+# divergence, which should sit at roundoff
+@numba.njit(parallel=True, nogil=True, cache=True)
+def reduce_snapshot(magnetic_x, magnetic_y, magnetic_z, dx):
+    """Compute the mean of the centered B^2 and the maximum divergence of the
+    face centered magnetic field in a single pass over the data
+
+    Args:
+        magnetic_x (np.ndarray): The x face centered magnetic field, shape (nx+1, ny, nz)
+        magnetic_y (np.ndarray): The y face centered magnetic field, shape (nx, ny+1, nz)
+        magnetic_z (np.ndarray): The z face centered magnetic field, shape (nx, ny, nz+1)
+        dx (np.ndarray): The cell sizes in each direction
+
+    Returns:
+        tuple: The mean of B^2 and the maximum divergence
+    """
+    nx = magnetic_y.shape[0]
+    ny = magnetic_x.shape[1]
+    nz = magnetic_x.shape[2]
+
+    # Per x-plane reductions so that the outer loop can run in parallel
+    b2_sums = np.zeros(nx)
+    div_max = np.full(nx, -np.inf)
+
+    for i in numba.prange(nx):
+        for j in range(ny):
+            for k in range(nz):
+                # Centered magnetic field
+                b_x = 0.5 * (magnetic_x[i+1, j, k] + magnetic_x[i, j, k])
+                b_y = 0.5 * (magnetic_y[i, j+1, k] + magnetic_y[i, j, k])
+                b_z = 0.5 * (magnetic_z[i, j, k+1] + magnetic_z[i, j, k])
+                b2_sums[i] += b_x*b_x + b_y*b_y + b_z*b_z
+
+                # Divergence
+                div = ( (magnetic_x[i+1, j, k] - magnetic_x[i, j, k]) / dx[0]
+                      + (magnetic_y[i, j+1, k] - magnetic_y[i, j, k]) / dx[1]
+                      + (magnetic_z[i, j, k+1] - magnetic_z[i, j, k]) / dx[2])
+                div_max[i] = max(div_max[i], div)
+
+    return b2_sums.sum() / (nx * ny * nz), div_max.max()
+# ==============================================================================
+
 # ==============================================================================
 def load_slices():
 
     def load_slice(filename):
-        data = shared_tools.load_conserved_data(filename, load_gamma=True, load_resolution=True)
+        # Only the magnetic energy is plotted so skip reading the other fields
+        data = shared_tools.load_magnetic_data(filename)
         data = shared_tools.center_magnetic_fields(data)
-        data = shared_tools.compute_velocities(data)
-        data = shared_tools.compute_derived_quantities(data, data['gamma'])
 
-        B_energy = data['magnetic_energy']
+        B_energy = 0.5 * (np.square(data['magnetic_x_centered'])
+                          + np.square(data['magnetic_y_centered'])
+                          + np.square(data['magnetic_z_centered']))
 
         side_slice = B_energy[:,B_energy.shape[1]//2,:]
 
-        top_slice = scipy.ndimage.rotate(B_energy, angle=45, axes=(1,2))
-        top_slice = top_slice[:,15:-16,top_slice.shape[2]//2]
+        # Linear interpolation only touches the cells around the slice. The
+        # cubic spline that scipy.ndimage.rotate uses has to prefilter the
+        # entire field first, and it overshoots at the edge of the loop
+        top_slice = scipy.ndimage.map_coordinates(B_energy,
+                                                  rotated_slice_coordinates(B_energy.shape),
+                                                  order=1)
 
         return np.rot90(side_slice), np.rot90(top_slice)
 
-    init_side, init_top   = load_slice('afl_n256_0')
-    final_side, final_top = load_slice('afl_n256_10')
+    init_side, init_top   = load_slice(slice_file_names[0])
+    final_side, final_top = load_slice(slice_file_names[1])
 
-    max_val = np.max(np.array([init_side, final_side, init_top, final_top]))
+    max_val = max(field.max() for field in [init_side, final_side, init_top, final_top])
 
     return {'init_side':init_side, 'init_top':init_top,
             'final_side':final_side, 'final_top':final_top, 'max':max_val}
 # ==============================================================================
 
+# ==============================================================================
+@functools.lru_cache
+def rotated_slice_coordinates(shape, angle=45, crop=(15, 16)):
+    """Compute the coordinates of the center slice of a field rotated in the
+    y-z plane. These are the same points that `scipy.ndimage.rotate` would
+    sample for that slice but without rotating the entire field
+
+    Args:
+        shape (tuple): The shape of the field
+        angle (float, optional): The rotation angle in degrees. Defaults to 45.
+        crop (tuple, optional): The number of points to crop from the start and end of the slice. Defaults to (15, 16).
+
+    Returns:
+        np.ndarray: The coordinates to pass to `scipy.ndimage.map_coordinates`
+    """
+    cos, sin   = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    rot_matrix = np.array([[cos, sin], [-sin, cos]])
+
+    # Find the shape of the rotated plane and the offset between the two planes
+    in_plane_shape  = np.array(shape[1:])
+    out_bounds      = rot_matrix @ [[0, 0, in_plane_shape[0], in_plane_shape[0]],
+                                    [0, in_plane_shape[1], 0, in_plane_shape[1]]]
+    out_plane_shape = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+    offset          = (in_plane_shape - 1) / 2 - rot_matrix @ ((out_plane_shape - 1) / 2)
+
+    # Map the points along the center of the rotated plane back to the field
+    out_points = np.stack([np.arange(crop[0], out_plane_shape[0] - crop[1]),
+                           np.full(out_plane_shape[0] - crop[0] - crop[1], out_plane_shape[1] // 2)])
+    in_points  = rot_matrix @ out_points + offset[:, np.newaxis]
+
+    coords    = np.empty((3, shape[0], out_points.shape[1]))
+    coords[0] = np.arange(shape[0])[:, np.newaxis]
+    coords[1] = in_points[0]
+    coords[2] = in_points[1]
+
+    return coords
+# ==============================================================================
+
 # ==============================================================================
 def plotAFL(outPath):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     line_width         = 1
     marker_size        = 5
@@ -189,10 +288,10 @@ def plotAFL(outPath):
         subplot_idx = subplot_indices[field]
 
         # Plot the data
-        for res in resolutions:
+        for res_idx, res in enumerate(resolutions):
             key    = f'{res}'
-            time   = data['times'][key]
-            y_data = data[field][key]
+            time   = data['times'][res_idx]
+            y_data = data[field][res_idx]
             subPlot[subplot_idx].plot(time,
                                       y_data,
                                       color=colors[key],
@@ -231,6 +330,8 @@ def plotAFL(outPath):
 
 # ==============================================================================
 def plotAFL_slice(outPath):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     line_width         = 0.4
     num_contours       = 30
@@ -244,10 +345,10 @@ def plotAFL_slice(outPath):
     fig, subPlot = plt.subplots(1,4, layout='constrained', figsize = (2*shared_tools.fig_width, shared_tools.fig_height))
 
     # Plot the data
-    subPlot[0].imshow(data['init_top'],   vmin=0.0, vmax=data['max'], cmap='Blues')#shared_tools.color_maps["magnetic_energy"])
-    subPlot[1].imshow(data['final_top'],  vmin=0.0, vmax=data['max'], cmap='Blues')#shared_tools.color_maps["magnetic_energy"])
-    subPlot[2].imshow(data['init_side'],  vmin=0.0, vmax=data['max'], cmap='Blues')#shared_tools.color_maps["magnetic_energy"])
-    subPlot[3].imshow(data['final_side'], vmin=0.0, vmax=data['max'], cmap='Blues')#shared_tools.color_maps["magnetic_energy"])
+    subPlot[0].imshow(data['init_top'],   vmin=0.0, vmax=data['max'], cmap='Blues', rasterized=True)#shared_tools.color_maps["magnetic_energy"])
+    subPlot[1].imshow(data['final_top'],  vmin=0.0, vmax=data['max'], cmap='Blues', rasterized=True)#shared_tools.color_maps["magnetic_energy"])
+    subPlot[2].imshow(data['init_side'],  vmin=0.0, vmax=data['max'], cmap='Blues', rasterized=True)#shared_tools.color_maps["magnetic_energy"])
+    subPlot[3].imshow(data['final_side'], vmin=0.0, vmax=data['max'], cmap='Blues', rasterized=True)#shared_tools.color_maps["magnetic_energy"])
 
     # # Set ticks and grid
     for i in range(4):
@@ -260,7 +361,7 @@ def plotAFL_slice(outPath):
     subPlot[3].text(.01, .99, r'$t=1.0$', ha='left', va='top', transform=subPlot[3].transAxes, fontsize=shared_tools.font_size_normal)
 
     # Save the figure and close it
-    plt.savefig(outPath / f'afl_slices.pdf', transparent = True)
+    plt.savefig(outPath / f'afl_slices.pdf', transparent = True, dpi=150)
     plt.close()
 # ==============================================================================
 
@@ -8,21 +8,12 @@
 """
 
 from timeit import default_timer
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import argparse
 import pathlib
 
 import shared_tools
 
-plt.close('all')
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
 # ==============================================================================
 def main():
     # Check for CLI arguments
@@ -57,6 +48,8 @@ def main():
 
 # ==============================================================================
 def plotBlastWave(rootPath, outPath):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     line_width         = 00.1
     num_contours       = 30
@@ -75,16 +68,14 @@ def plotBlastWave(rootPath, outPath):
     # fig.suptitle(f'', fontsize=suptitle_font_size)
 
     # Load data
-    data = shared_tools.load_conserved_data('mhd-blast', load_gamma=True, load_resolution=True)
-    data = shared_tools.center_magnetic_fields(data)
-    data = shared_tools.slice_data(data, z_slice_loc=data['resolution'][2]//2)
-    data = shared_tools.compute_velocities(data)
+    data = shared_tools.load_conserved_slice('mhd-blast', load_gamma=True)
+    data = shared_tools.compute_velocities(data, inplace=True)
     data = shared_tools.compute_derived_quantities(data, data['gamma'])
 
     for field in fields:
         # Get info for this field
         subplot_idx = field_indices[field]
-        field_data  = np.fliplr(np.rot90(data[field]))
+        field_data  = data[field][::-1, ::-1].T # same as np.fliplr(np.rot90(data[field])) but a single view
 
         # Compute where the contours are
         contours = np.linspace(np.min(field_data), np.max(field_data), num_contours)
@@ -8,21 +8,14 @@
 """
 
 from timeit import default_timer
-import matplotlib
-import matplotlib.pyplot as plt
+import concurrent.futures
+import itertools
 import numpy as np
 import argparse
 import pathlib
 
 import shared_tools
 
-plt.close('all')
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
 # 1. (optionally) Run Cholla
 #   a. Resolutions: 16, 32, 64, 128, 256, 512
 #   b. All 4 waves
@@ -48,6 +41,7 @@ def main():
     parser.add_argument('-o', '--out_path', help='The path of the directory to write the plots out to. Defaults to writing in the same directory as the input files')
     parser.add_argument('-r', '--run_cholla', action="store_true", help='Runs cholla to generate all the data')
     parser.add_argument('-l', '--l2_norms', action="store_true", help='Compute the L2 Norms')
+    parser.add_argument('-j', '--jobs', type=int, help='The maximum number of L2 Norms to compute concurrently. Defaults to one per L2 Norm, limited by the number of CPUs')
     parser.add_argument('-f', '--figure', action="store_true", help='Generate the plots')
 
 
@@ -67,7 +61,7 @@ def main():
         runCholla()
 
     if args.l2_norms:
-        computeL2Norm()
+        computeL2Norm(args.jobs)
 
     if args.figure:
         plotL2Norm(OutPath)
@@ -94,40 +88,28 @@ def runCholla():
 # ==============================================================================
 
 # ==============================================================================
-def computeL2Norm():
-    # Setup dictionary to hold data
-    l2_data = {}
-    for reconstructor in reconstructors:
-        for wave in waves:
-            for resolution in resolutions:
-                l2_data[f'{reconstructor}_{wave}'] = []
-
-    # Setup dictionary to hold data
-    for reconstructor in reconstructors:
-        for wave in waves:
-            for resolution in resolutions:
-                # Determine file paths and load the files
-                initial_data = shared_tools.load_conserved_data(f'cpaw_{reconstructor}_{wave}_{resolution}_initial')
-                final_data   = shared_tools.load_conserved_data(f'cpaw_{reconstructor}_{wave}_{resolution}_final')
-
-                # Get a list of all the data sets
-                fields = initial_data.keys()
-
-                # Compute the L2 Norm
-                L2Norm = 0.0
-                for field in fields:
-                    diff = np.abs(initial_data[field] - final_data[field])
-                    L1Error = np.sum(diff) / (initial_data[field]).size
-                    L2Norm += np.power(L1Error, 2)
-
-                L2Norm = np.sqrt(L2Norm)
-                l2_data[f'{reconstructor}_{wave}'].append(L2Norm)
+def computeL2Norm(max_workers=None):
+    # Every combination is independent so compute them concurrently
+    runs        = list(itertools.product(reconstructors, waves, resolutions))
+    max_workers = shared_tools.max_concurrent_workers(len(runs), max_workers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        L2Norms = list(executor.map(shared_tools.compute_l2_norm,
+                                    [f'cpaw_{reconstructor}_{wave}_{resolution}_initial' for reconstructor, wave, resolution in runs],
+                                    [f'cpaw_{reconstructor}_{wave}_{resolution}_final' for reconstructor, wave, resolution in runs]))
+
+    # Store the L2 norms of each reconstructor and wave in an array ordered by
+    # resolution
+    l2_data = {f'{reconstructor}_{wave}':np.empty(len(resolutions)) for reconstructor, wave in itertools.product(reconstructors, waves)}
+    for (reconstructor, wave, resolution), L2Norm in zip(runs, L2Norms):
+        l2_data[f'{reconstructor}_{wave}'][resolutions.index(resolution)] = L2Norm
 
     shared_tools.pickle_dictionary(l2_data, save_path)
 # ==============================================================================
 
 # ==============================================================================
 def plotL2Norm(outPath, normalize = False):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     data_linestyle     = '-'
     linewidth          = 1
@@ -139,10 +121,16 @@ def plotL2Norm(outPath, normalize = False):
     scaling_color      = 'black'
 
     # Plot the L2 Norm data
-    fig, subPlot = plt.subplots(1, 2, figsize = (2*shared_tools.fig_width, shared_tools.fig_height))
+    fig, subPlot = plt.subplots(1, 2, layout='constrained', figsize = (2*shared_tools.fig_width, shared_tools.fig_height))
 
     wave_position = {'standing':0, 'moving':1}
 
+    # The shape of the scaling lines is the same for every wave, they're just
+    # normalized to the second PLMC point
+    scalingRes     = np.array([resolutions[0], resolutions[1], resolutions[-1]])
+    scaling_powers = [2]
+    scaling_shapes = {i:(scalingRes[1] / scalingRes)**i for i in scaling_powers}
+
     # Load the L2 Norms data
     L2Norms = shared_tools.unpickle_dictionary(save_path)
 
@@ -177,12 +165,10 @@ def plotL2Norm(outPath, normalize = False):
                                   label      = 'PPMC')
 
         # Plot the scaling lines
-        scalingRes = [resolutions[0], resolutions[1], resolutions[-1]]
         # loop through the different scaling powers
-        for i in [2]:
+        for i in scaling_powers:
             label = r'$\mathcal{O}(\Delta x^' + str(i) + r')$'
-            norm_point = plmc_data[1]
-            scaling_data = np.array([norm_point / np.power(scalingRes[0]/scalingRes[1], i), norm_point, norm_point / np.power(scalingRes[-1]/scalingRes[1], i)])
+            scaling_data = plmc_data[1] * scaling_shapes[i]
             subPlot[subplot_idx].plot(scalingRes, scaling_data, color=scaling_color, alpha=alpha, linestyle=scaling_linestyle, linewidth=linewidth, label=label)
 
         # Set axis parameters
@@ -203,7 +189,6 @@ def plotL2Norm(outPath, normalize = False):
 
         subPlot[subplot_idx].set_box_aspect(1)
 
-    plt.tight_layout()
     plt.savefig(outPath / f'cpaw_convergence.pdf', transparent = True)
     plt.close()
 # ==============================================================================
@@ -3,28 +3,34 @@
 ================================================================================
  Written by Robert Caddy.
 
- Loads and returns the link to the requested key
+ Loads and returns the links to the requested keys. Keys can be given as
+ arguments or, if there are none, read from stdin so that all the
+ links can be resolved with a single invocation
 ================================================================================
 """
 
-import pickle
+import json
 import argparse
 import pathlib
+import sys
 
 
 def main():
     # Check for CLI arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('key', help='The key to the link to load')
+    parser.add_argument('keys', nargs='*', help='The keys to the links to load. If none are given they are read from stdin')
     args = parser.parse_args()
 
-    path = pathlib.Path(__file__).resolve().parent.parent / 'python' / 'links.pkl'
-    with open(path, 'rb') as file:
-        links = pickle.load(file)
+    keys = args.keys if args.keys else sys.stdin.read().split()
 
-    link = f'\href{{{links[args.key]}}}{{\img{{github.png}}}}'
+    path = pathlib.Path(__file__).resolve().parent.parent / 'python' / 'links.json'
+    with open(path, 'r') as file:
+        links = json.load(file)
 
-    print(link)
+    for key in keys:
+        link = f'\href{{{links[key]}}}{{\img{{github.png}}}}'
+
+        print(link)
 
 
 if __name__ == '__main__':
@@ -9,21 +9,16 @@
 """
 
 from timeit import default_timer
-import matplotlib
-import matplotlib.pyplot as plt
+import concurrent.futures
+import hashlib
+import itertools
+import threading
 import numpy as np
 import argparse
 import pathlib
 
 import shared_tools
 
-plt.close('all')
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
 # 1. (optionally) Run Cholla
 #   a. Resolutions: 16, 32, 64, 128, 256, 512
 #   b. All 4 waves
@@ -37,6 +32,12 @@ reconstructors = ['plmc', 'ppmc']
 waves          = ['alfven_wave', 'fast_magnetosonic', 'mhd_contact_wave', 'slow_magnetosonic']
 resolutions    = [16, 32, 64, 128, 256, 512]
 
+# Cache of the computed L2 norms
+l2_cache_path = shared_tools.data_files_path / 'linear_wave_l2_norms_cache.pkl'
+
+# Per thread storage for the buffers used when computing the L2 norms
+thread_buffers = threading.local()
+
 # ==============================================================================
 def main():
     # Check for CLI arguments
@@ -44,7 +45,9 @@ def main():
     parser.add_argument('-p', '--in_path', help='The path to the directory that the source files are located in. Defaults to "~/Code/cholla/bin"')
     parser.add_argument('-o', '--out_path', help='The path of the directory to write the plots out to. Defaults to writing in the same directory as the input files')
     parser.add_argument('-r', '--run_cholla', action="store_true", help='Runs cholla to generate all the data')
+    parser.add_argument('-j', '--jobs', type=int, help='The maximum number of Cholla runs or L2 norms to compute concurrently. Defaults to one per run, limited by the number of CPUs')
     parser.add_argument('-f', '--figure', action="store_true", help='Generate the plots')
+    parser.add_argument('--force', action="store_true", help='Recompute all the L2 norms instead of using the cached values')
 
 
     args = parser.parse_args()
@@ -60,68 +63,97 @@ def main():
         OutPath = pathlib.Path(__file__).resolve().parent.parent / 'latex-src'
 
     if args.run_cholla:
-        runCholla()
+        runCholla(args.jobs)
 
     if args.figure:
-        L2Norms = computeL2Norm(rootPath)
+        L2Norms = computeL2Norm(rootPath, args.jobs, force=args.force)
         plotL2Norm(L2Norms, OutPath)
         shared_tools.update_plot_entry('linear_wave_convergence', 'python/linear-wave-convergence.py')
 
 # ==============================================================================
 
 # ==============================================================================
-def runCholla():
-    # Loop over the lists and run cholla for each combination
-    for reconstructor in reconstructors:
-        for wave in waves:
-            for resolution in resolutions:
-                shared_tools.cholla_runner(reconstructor=reconstructor,
-                                           param_file_name=f'{wave}.txt',
-                                           cholla_cli_args=f'nx={resolution} ny=16 nz=16',
-                                           move_initial=True,
-                                           move_final=True,
-                                           initial_filename=f'{reconstructor}_{wave}_{resolution}_initial',
-                                           final_filename=f'{reconstructor}_{wave}_{resolution}_final')
-
-                # Print status
-                print(f'Finished with {resolution}, {wave}, {reconstructor}')
+def runCholla(max_workers=None):
+    # Every combination is an independent run so launch them concurrently
+    runs = list(itertools.product(reconstructors, waves, resolutions))
+    max_workers = shared_tools.max_concurrent_workers(len(runs), max_workers)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_single_wave, *zip(*runs)))
+# ==============================================================================
+
+# ==============================================================================
+def run_single_wave(reconstructor, wave, resolution):
+    shared_tools.cholla_runner(reconstructor=reconstructor,
+                               param_file_name=f'{wave}.txt',
+                               cholla_cli_args=f'nx={resolution} ny=16 nz=16',
+                               move_initial=True,
+                               move_final=True,
+                               initial_filename=f'{reconstructor}_{wave}_{resolution}_initial',
+                               final_filename=f'{reconstructor}_{wave}_{resolution}_final')
+
+    # Print status
+    print(f'Finished with {resolution}, {wave}, {reconstructor}')
+# ==============================================================================
+
+# ==============================================================================
+def computeL2Norm(rootPath, max_workers=None, force=False):
+    # Load the cache of previously computed L2 norms
+    cache = {} if force else shared_tools.unpickle_dictionary(l2_cache_path)
+
+    def cached_l2_norm(reconstructor, wave, resolution):
+        # Only recompute the L2 norm if the data or the parameter file changed
+        key       = f'{reconstructor}_{wave}_{resolution}'
+        signature = l2_norm_signature(reconstructor, wave, resolution)
+        if key in cache and cache[key][0] == signature:
+            return cache[key][1]
+
+        # Buffers for the datasets that can't be memory mapped, these are reused
+        # for every file that this thread processes
+        if not hasattr(thread_buffers, 'buffers'):
+            thread_buffers.buffers = {}
+
+        L2Norm     = shared_tools.compute_l2_norm(f'{key}_initial', f'{key}_final', buffers=thread_buffers.buffers)
+        cache[key] = (signature, L2Norm)
+        return L2Norm
+
+    # Compute the L2 norms concurrently. h5py holds a global lock for every call
+    # so the HDF5 reads themselves don't overlap, but the L1 error kernel
+    # releases the GIL and memory mapped fields are read outside of h5py, so
+    # those parts run in parallel
+    runs        = list(itertools.product(reconstructors, waves, resolutions))
+    max_workers = shared_tools.max_concurrent_workers(len(runs), max_workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        L2Norms = executor.map(cached_l2_norm, *zip(*runs))
+
+        # Map returns the results in the same order as the runs which is the
+        # same as the C order of a (reconstructor, wave, resolution) array
+        l2_data = np.fromiter(L2Norms, dtype=np.float64, count=len(runs))
+
+    shared_tools.pickle_dictionary(cache, l2_cache_path)
+
+    return l2_data.reshape(len(reconstructors), len(waves), len(resolutions))
 # ==============================================================================
 
 # ==============================================================================
-def computeL2Norm(rootPath):
-    # Setup dictionary to hold data
-    l2_data = {}
-    for reconstructor in reconstructors:
-        for wave in waves:
-            for resolution in resolutions:
-                l2_data[f'{reconstructor}_{wave}'] = []
-
-    # Setup dictionary to hold data
-    for reconstructor in reconstructors:
-        for wave in waves:
-            for resolution in resolutions:
-                # Determine file paths and load the files
-                initial_data = shared_tools.load_conserved_data(f'{reconstructor}_{wave}_{resolution}_initial')
-                final_data   = shared_tools.load_conserved_data(f'{reconstructor}_{wave}_{resolution}_final')
-
-                # Get a list of all the data sets
-                fields = initial_data.keys()
-
-                # Compute the L2 Norm
-                L2Norm = 0.0
-                for field in fields:
-                    diff = np.abs(initial_data[field] - final_data[field])
-                    L1Error = np.sum(diff) / (initial_data[field]).size
-                    L2Norm += np.power(L1Error, 2)
-
-                L2Norm = np.sqrt(L2Norm)
-                l2_data[f'{reconstructor}_{wave}'].append(L2Norm)
-
-    return l2_data
+def l2_norm_signature(reconstructor, wave, resolution):
+    # The modification time and size of both data files along with a hash of
+    # the parameter file. If any of these change the L2 norm must be recomputed
+    signature = []
+    for state in ['initial', 'final']:
+        file_stats = (shared_tools.data_files_path / f'{reconstructor}_{wave}_{resolution}_{state}.h5').stat()
+        signature += [file_stats.st_mtime_ns, file_stats.st_size]
+
+    param_file_path = shared_tools.repo_root / 'python' / 'cholla-config-files' / f'{wave}.txt'
+    signature.append(hashlib.sha256(param_file_path.read_bytes()).hexdigest())
+
+    return tuple(signature)
 # ==============================================================================
 
 # ==============================================================================
 def plotL2Norm(L2Norms, outPath, normalize = False):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     data_linestyle     = '-'
     linewidth          = 1
@@ -133,20 +165,29 @@ def plotL2Norm(L2Norms, outPath, normalize = False):
     scaling_color      = 'black'
 
     # Plot the L2 Norm data
-    fig, subPlot = plt.subplots(2, 2, figsize = (2*shared_tools.fig_width, 2*shared_tools.fig_height))
+    fig, subPlot = plt.subplots(2, 2, layout='constrained', figsize = (2*shared_tools.fig_width, 2*shared_tools.fig_height))
 
     wave_position = {'alfven_wave':(1,0), 'fast_magnetosonic':(0,1), 'mhd_contact_wave':(1,1), 'slow_magnetosonic':(0,0)}
 
-    for wave in waves:
+    # The shape of the scaling lines is the same for every wave, they're just
+    # normalized to the second PLMC point
+    scalingRes     = np.array([resolutions[0], resolutions[1], resolutions[-1]])
+    scaling_powers = [2]
+    scaling_shapes = {i:(scalingRes[1] / scalingRes)**i for i in scaling_powers}
+
+    plmc_idx = reconstructors.index('plmc')
+    ppmc_idx = reconstructors.index('ppmc')
+
+    for wave_idx, wave in enumerate(waves):
         subplot_idx = wave_position[wave]
         # Optionally, normalize the data
         if normalize:
-            plmc_data = L2Norms[f'plmc_{wave}'] / L2Norms[f'plmc_{wave}'][0]
-            ppmc_data = L2Norms[f'ppmc_{wave}'] / L2Norms[f'ppmc_{wave}'][0]
+            plmc_data = L2Norms[plmc_idx, wave_idx] / L2Norms[plmc_idx, wave_idx, 0]
+            ppmc_data = L2Norms[ppmc_idx, wave_idx] / L2Norms[ppmc_idx, wave_idx, 0]
             norm_name = "Normalized "
         else:
-            plmc_data = L2Norms[f'plmc_{wave}']
-            ppmc_data = L2Norms[f'ppmc_{wave}']
+            plmc_data = L2Norms[plmc_idx, wave_idx]
+            ppmc_data = L2Norms[ppmc_idx, wave_idx]
             norm_name = ''
 
         # Plot raw data
@@ -168,12 +209,10 @@ def plotL2Norm(L2Norms, outPath, normalize = False):
                                   label      = 'PPMC')
 
         # Plot the scaling lines
-        scalingRes = [resolutions[0], resolutions[1], resolutions[-1]]
         # loop through the different scaling powers
-        for i in [2]:
+        for i in scaling_powers:
             label = r'$\mathcal{O}(\Delta x^' + str(i) + r')$'
-            norm_point = plmc_data[1]
-            scaling_data = np.array([norm_point / np.power(scalingRes[0]/scalingRes[1], i), norm_point, norm_point / np.power(scalingRes[-1]/scalingRes[1], i)])
+            scaling_data = plmc_data[1] * scaling_shapes[i]
             subPlot[subplot_idx].plot(scalingRes, scaling_data, color=scaling_color, alpha=alpha, linestyle=scaling_linestyle, linewidth=linewidth, label=label)
 
         # Set axis parameters
@@ -194,7 +233,6 @@ def plotL2Norm(L2Norms, outPath, normalize = False):
         subPlot[subplot_idx].legend(fontsize=shared_tools.font_size_small)
         subPlot[subplot_idx].set_box_aspect(1)
 
-    plt.tight_layout()
     plt.savefig(outPath / f'linear_convergence.pdf', transparent = True)
     plt.close()
 # ==============================================================================
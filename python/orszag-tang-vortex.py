@@ -8,21 +8,11 @@
 """
 
 from timeit import default_timer
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
 import argparse
 import pathlib
 
 import shared_tools
 
-plt.close('all')
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
 # ==============================================================================
 def main():
     # Check for CLI arguments
@@ -56,6 +46,8 @@ def main():
 
 # ==============================================================================
 def plotOTV(rootPath, outPath):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     line_width         = 0.4
     num_contours       = 30
@@ -72,22 +64,19 @@ def plotOTV(rootPath, outPath):
     # fig.suptitle(f'', fontsize=suptitle_font_size)
 
     # Load data
-    data = shared_tools.load_conserved_data('orszag_tang_vortex', load_gamma=True, load_resolution=True)
-    data = shared_tools.center_magnetic_fields(data)
-    data = shared_tools.slice_data(data, z_slice_loc=data['resolution'][2]//2)
-    data = shared_tools.compute_velocities(data)
+    data = shared_tools.load_conserved_slice('orszag_tang_vortex', load_gamma=True)
+    data = shared_tools.compute_velocities(data, inplace=True)
     data = shared_tools.compute_derived_quantities(data, data['gamma'])
 
     for field in fields:
         # Get info for this field
         subplot_idx = field_indices[field]
-        field_data  = np.rot90(data[field])
-
-        # Compute where the contours are
-        contours = np.linspace(np.min(field_data), np.max(field_data), num_contours)
+        field_data  = data[field].T[::-1]  # rotated 90 degrees, as a view
 
-        # Plot the data
-        subPlot[subplot_idx].contour(field_data, levels=num_contours, cmap=shared_tools.color_maps[field], linewidths=line_width)
+        # Plot the data. The contours are drawn below the rasterization zorder
+        # so they're rasterized in the PDF
+        subPlot[subplot_idx].contour(field_data, levels=num_contours, cmap=shared_tools.color_maps[field], linewidths=line_width, zorder=0)
+        subPlot[subplot_idx].set_rasterization_zorder(1)
 
         # Set ticks and grid
         subPlot[subplot_idx].tick_params(labelleft=False, labelbottom=False,
@@ -100,7 +89,7 @@ def plotOTV(rootPath, outPath):
         subPlot[subplot_idx].set_title(f'{shared_tools.pretty_names[field]}', fontsize=shared_tools.font_size_normal)
 
     # Save the figure and close it
-    plt.savefig(outPath / f'orszag-tang-vortex.pdf', transparent = True)
+    plt.savefig(outPath / f'orszag-tang-vortex.pdf', transparent = True, dpi=150)
     plt.close()
 # ==============================================================================
 
@@ -9,31 +9,18 @@
 """
 
 from timeit import default_timer
+import itertools
+import types
 import numpy as np
 import pandas as pd
 import pathlib
 import matplotlib
+matplotlib.use("Agg")
 import matplotlib.ticker
 import matplotlib.pyplot as plt
 import argparse
 import shared_tools
 
-matplotlib.use("Agg")
-plt.style.use('seaborn-v0_8-colorblind')
-
-# axes_color = '0.1'
-# plt.rcParams['axes.facecolor']    = axes_color
-# plt.rcParams['figure.facecolor']  = background_color
-# plt.rcParams['patch.facecolor']   = background_color
-# plt.rcParams['savefig.facecolor'] = background_color
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
-plt.close('all')
-
 # ==============================================================================
 def main():
     data_path = shared_tools.repo_root / 'scaling-tests' / 'data' / '2024-03-13-fused-pcm'
@@ -43,14 +30,20 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-w', '--weak',   action="store_true", help='Generate the weak scaling plots')
     parser.add_argument('-s', '--strong', action="store_true", help='Generate the strong scaling plot')
+    parser.add_argument('--force', action="store_true", help='Reparse the weak scaling logs instead of using the cached data')
     args = parser.parse_args()
 
+    # Only set up the plot style if there's something to plot
+    if args.weak or args.strong:
+        setup_plot_style()
+
     if args.weak:
-        scaling_data = load_data(data_path)
+        scaling_data = load_data(data_path, force=args.force)
+        timings      = weak_scaling_inputs(scaling_data)
 
-        cells_per_second_plot(scaling_data)
-        weak_scaling_efficiency(scaling_data)
-        ms_per_timestep(scaling_data)
+        cells_per_second_plot(timings)
+        weak_scaling_efficiency(timings)
+        ms_per_timestep(timings)
 
         shared_tools.update_plot_entry('scaling', 'python/scaling_plots.py')
 
@@ -60,39 +53,76 @@ def main():
 # ==============================================================================
 
 # ==============================================================================
-def load_data(data_path):
+def setup_plot_style():
+    plt.style.use('seaborn-v0_8-colorblind')
+
+    # axes_color = '0.1'
+    # plt.rcParams['axes.facecolor']    = axes_color
+    # plt.rcParams['figure.facecolor']  = background_color
+    # plt.rcParams['patch.facecolor']   = background_color
+    # plt.rcParams['savefig.facecolor'] = background_color
+
+    shared_tools.apply_paper_style()
+# ==============================================================================
+
+# ==============================================================================
+def load_data(data_path, force=False):
     # Get paths
-    data_dirs = sorted(pathlib.Path(data_path).glob('ranks*'))
-
-    # Setup dataframe
-    file_name = data_dirs[0] / 'run_timing.log'
-    with open(file_name, 'r') as file:
-        lines        = file.readlines()
-        header       = lines[5][1:].split()
-        scaling_data = pd.DataFrame(index=header)
-
-    # Loop through the directories and load the data
-    for path in data_dirs:
-        file_name = path / 'run_timing.log'
+    data_path = pathlib.Path(data_path)
+    data_dirs = sorted(data_path.glob('ranks*'))
+    log_files = [path / 'run_timing.log' for path in data_dirs]
+
+    # Reuse the previously parsed data if no runs were added or removed and none
+    # of the logs changed since it was cached
+    cache_path = shared_tools.data_files_path / f'scaling_{data_path.name}.pkl'
+    if not force and shared_tools.is_up_to_date(cache_path, [data_path] + [file_name for file_name in log_files if file_name.is_file()]):
+        return pd.read_pickle(cache_path)
+
+    # Get the header, only reading up to the line it's on
+    with open(log_files[0], 'r') as file:
+        header = next(itertools.islice(file, 5, 6))[1:].split()
+
+    # Parse the data line from each directory, without reading the rest of the
+    # file, straight into one array where each run is a column
+    runs   = np.empty((len(header), len(log_files)), dtype=np.float64)
+    n_runs = 0
+    for file_name in log_files:
         if file_name.is_file():
             with open(file_name, 'r') as file:
-                lines  = file.readlines()
-                data   = lines[6].split()
-                scaling_data[int(data[0])] = pd.to_numeric(data)
+                runs[:, n_runs] = np.fromstring(next(itertools.islice(file, 6, 7)), sep=' ')
+            n_runs += 1
         else:
             print(f'File: {file_name} not found.')
+    runs = runs[:, :n_runs]
+
+    # Label each run by its number of ranks and sort them
+    n_proc       = runs[header.index('n_proc')].astype(np.int64)
+    order        = np.argsort(n_proc)
+    scaling_data = pd.DataFrame(runs[:, order], index=header, columns=n_proc[order])
 
-    scaling_data = scaling_data.reindex(sorted(scaling_data.columns), axis=1)
+    scaling_data.to_pickle(cache_path)
 
     return scaling_data
 # ==============================================================================
 
 # ==============================================================================
-def cells_per_second_plot(scaling_data):
+def weak_scaling_inputs(scaling_data):
+    # Convert the data to a dictionary of arrays, one per row, in a single pass
+    # and extract the arrays that every weak scaling plot uses once instead of
+    # in every call to the plotting functions
+    rows   = dict(zip(scaling_data.index, scaling_data.to_numpy()))
+    n_proc = rows['n_proc']
+
+    return types.SimpleNamespace(rows          = rows,
+                                 n_proc        = n_proc,
+                                 n_steps       = rows['n_steps'] - 1,
+                                 cells_per_gpu = rows['nx'] * rows['ny'] * rows['nz'] / n_proc)
+# ==============================================================================
+
+# ==============================================================================
+def cells_per_second_plot(timings):
     # Instantiate Plot
-    fig = plt.figure(0, figsize=(15, 10))
-    fig.clf()
-    ax = plt.gca()
+    fig, ax = plt.subplots(figsize=(15, 10))
 
     # Set plot settings
     # Defaults colors #0072B2, #009E73, #D55E00, #CC79A7, #F0E442, #56B4E9
@@ -105,13 +135,12 @@ def cells_per_second_plot(scaling_data):
     marker_size     = 10
 
     # Plot the data
-    ax, x, y = cells_per_second_per_gpu(scaling_data, 'Total', color_total, 'Total', ax, marker_size, marker_style=marker_style_total)
+    ax, x, y = cells_per_second_per_gpu(timings, 'Total', color_total, 'Total', ax, marker_size, marker_style=marker_style_total)
     # Note that the timer for the integrator is named "Hydro" not "MHD"
-    ax = cells_per_second_per_gpu(scaling_data, 'Hydro_Integrator', color_mhd, 'MHD Integrator', ax, marker_size, marker_style=marker_style_mhd)[0]
+    ax = cells_per_second_per_gpu(timings, 'Hydro_Integrator', color_mhd, 'MHD Integrator', ax, marker_size, marker_style=marker_style_mhd)[0]
 
     # Print the performance results
-    for i in range(len(x)):
-        print(f'Ranks: {int(x[i]):5d} updating at {round(y[i]/1.E8,4):3.4f}E8 cell updates per second per gpu')
+    print('\n'.join(f'Ranks: {int(ranks):5d} updating at {round(rate/1.E8,4):3.4f}E8 cell updates per second per gpu' for ranks, rate in zip(x, y)))
 
     # Setup the rest of the plot
     ax.set_xlim(xmin = 0.7, xmax = 1E5)
@@ -147,14 +176,14 @@ def cells_per_second_plot(scaling_data):
     fig.tight_layout()
 
     output_path = shared_tools.repo_root / 'latex-src' / f'scaling_tests_cells_per_second.pdf'
-    fig.savefig(output_path, dpi=400)
+    fig.savefig(output_path)
+    plt.close(fig)
 # ==============================================================================
 
 # ==============================================================================
-def weak_scaling_efficiency(scaling_data):
+def weak_scaling_efficiency(timings):
     # Instantiate Plot
-    fig = plt.figure(1, figsize=(shared_tools.fig_height, shared_tools.fig_height))
-    ax = plt.gca()
+    fig, ax = plt.subplots(figsize=(shared_tools.fig_height, shared_tools.fig_height))
 
     # Set plot settings
     # Defaults colors #0072B2, #009E73, #D55E00, #CC79A7, #F0E442, #56B4E9
@@ -167,14 +196,13 @@ def weak_scaling_efficiency(scaling_data):
     marker_size        = 5
 
     # Plot the data
-    ax, x, y = weak_scaling_efficiency_plot(scaling_data, 'Total', color_total, 'Total', ax, marker_size, marker_style=marker_style_total)
+    ax, x, y = weak_scaling_efficiency_plot(timings, 'Total', color_total, 'Total', ax, marker_size, marker_style=marker_style_total)
     # Note that the timer for the integrator is named "Hydro" not "MHD"
-    # ax = weak_scaling_efficiency_plot(scaling_data, 'Hydro_Integrator', color_mhd, 'MHD Integrator', ax, marker_size, marker_style=marker_style_mhd)
+    # ax = weak_scaling_efficiency_plot(timings, 'Hydro_Integrator', color_mhd, 'MHD Integrator', ax, marker_size, marker_style=marker_style_mhd)
 
     # Print the performance results
     print()
-    for i in range(len(x)):
-        print(f'Ranks: {int(x[i]):5d}, weak scaling efficiency: {round(y[i],2):5.2f}')
+    print('\n'.join(f'Ranks: {int(ranks):5d}, weak scaling efficiency: {round(efficiency,2):5.2f}' for ranks, efficiency in zip(x, y)))
 
     # Setup the rest of the plot
     ax.set_xlim(xmin = 0.7, xmax = 1E5)
@@ -207,14 +235,14 @@ def weak_scaling_efficiency(scaling_data):
     fig.tight_layout()
 
     output_path = shared_tools.repo_root / 'latex-src' / f'scaling_tests_weak_efficiency.pdf'
-    fig.savefig(output_path, dpi=400)
+    fig.savefig(output_path)
+    plt.close(fig)
 # ==============================================================================
 
 # ==============================================================================
-def ms_per_timestep(scaling_data):
+def ms_per_timestep(timings):
     # Instantiate Plot
-    fig = plt.figure(3, figsize=(shared_tools.fig_height, shared_tools.fig_height))
-    ax = plt.gca()
+    fig, ax = plt.subplots(figsize=(shared_tools.fig_height, shared_tools.fig_height))
 
     # Set plot settings
     # Defaults colors #0072B2, #009E73, #D55E00, #CC79A7, #F0E442, #56B4E9
@@ -228,15 +256,15 @@ def ms_per_timestep(scaling_data):
 
     # Plot the data
     scale_to = 256**3
-    ax, x, y = ms_per_timestep_plot(scaling_data, 'Total', color_total, 'Total runtime (excluding initialization)', ax, marker_size, marker_style=marker_style_total, scale_to=scale_to)
-    ax = ms_per_timestep_plot(scaling_data, 'Boundaries', color_mpi, 'MPI Communication', ax, marker_size, marker_style=marker_style_mpi, scale_to=scale_to)[0]
+    ax, x, y = ms_per_timestep_plot(timings, 'Total', color_total, 'Total runtime (excluding initialization)', ax, marker_size, marker_style=marker_style_total, scale_to=scale_to)
+    ax = ms_per_timestep_plot(timings, 'Boundaries', color_mpi, 'MPI Communication', ax, marker_size, marker_style=marker_style_mpi, scale_to=scale_to)[0]
     # Note that the timer for the integrator is named "Hydro" not "MHD"
-    ax = ms_per_timestep_plot(scaling_data, 'Hydro_Integrator', color_mhd, 'MHD Integrator', ax, marker_size, marker_style=marker_style_mhd, scale_to=scale_to)[0]
+    ax = ms_per_timestep_plot(timings, 'Hydro_Integrator', color_mhd, 'MHD Integrator', ax, marker_size, marker_style=marker_style_mhd, scale_to=scale_to)[0]
 
     # Print the performance results
     print()
-    for i in range(len(x)):
-        print(f'Ranks: {int(x[i]):5d},  ms/{int(np.cbrt(scale_to))}^3 cells/GPU: {round(y[i],2):5.2f}')
+    scale_to_side = int(np.cbrt(scale_to))
+    print('\n'.join(f'Ranks: {int(ranks):5d},  ms/{scale_to_side}^3 cells/GPU: {round(ms,2):5.2f}' for ranks, ms in zip(x, y)))
 
     # Setup the rest of the plot
     ax.set_xlim(xmin = 0.7, xmax = 1E5)
@@ -279,13 +307,14 @@ def ms_per_timestep(scaling_data):
     fig.tight_layout()
 
     output_path = shared_tools.repo_root / 'latex-src' / f'scaling_tests_ms_per_gpu.pdf'
-    fig.savefig(output_path, dpi=400)
+    fig.savefig(output_path)
+    plt.close(fig)
 # ==============================================================================
 
 # ==============================================================================
-def weak_scaling_efficiency_plot(scaling_data, name, color, label, ax, marker_size, marker_style):
-    x = scaling_data.loc['n_proc'].to_numpy()
-    y = scaling_data.loc[name].to_numpy() / (scaling_data.loc['n_steps'].to_numpy() - 1)
+def weak_scaling_efficiency_plot(timings, name, color, label, ax, marker_size, marker_style):
+    x = timings.n_proc
+    y = timings.rows[name] / timings.n_steps
 
     # Normalize to percentage
     y = (y[0] / y) * 100
@@ -296,12 +325,12 @@ def weak_scaling_efficiency_plot(scaling_data, name, color, label, ax, marker_si
 # ==============================================================================
 
 # ==============================================================================
-def ms_per_timestep_plot(scaling_data, name, color, label, ax, marker_size, marker_style, scale_to):
-    x = scaling_data.loc['n_proc'].to_numpy()
-    y = scaling_data.loc[name].to_numpy() / (scaling_data.loc['n_steps'].to_numpy() - 1)
+def ms_per_timestep_plot(timings, name, color, label, ax, marker_size, marker_style, scale_to):
+    x = timings.n_proc
+    y = timings.rows[name] / timings.n_steps
 
-    # Scale to the requested number of cells
-    n_cells_per_gpu = int(scaling_data.loc['nx'][1]) * int(scaling_data.loc['ny'][1]) * int(scaling_data.loc['nz'][1])
+    # Scale to the requested number of cells, using the single rank run
+    n_cells_per_gpu = timings.cells_per_gpu[x == 1][0]
     y *= scale_to / n_cells_per_gpu
 
     ax.plot(x, y, '--', c=color, marker=marker_style, markersize=marker_size, label=label)
@@ -309,17 +338,13 @@ def ms_per_timestep_plot(scaling_data, name, color, label, ax, marker_size, mark
 # ==============================================================================
 
 # ==============================================================================
-def cells_per_second_per_gpu(scaling_data, name, color, label, ax, marker_size, marker_style, delete_first=None):
-    x = (scaling_data.loc['n_proc'].to_numpy())
-
-    cells_per_gpu = ( scaling_data.loc['nx'].to_numpy()
-                    * scaling_data.loc['ny'].to_numpy()
-                    * scaling_data.loc['nz'].to_numpy()) / x
+def cells_per_second_per_gpu(timings, name, color, label, ax, marker_size, marker_style, delete_first=None):
+    x = timings.n_proc
 
-    avg_time_step = scaling_data.loc[name].to_numpy() / (scaling_data.loc['n_steps'].to_numpy() - 1)
+    avg_time_step = timings.rows[name] / timings.n_steps
     avg_time_step /= 1000 # convert to seconds from ms
 
-    y = cells_per_gpu / avg_time_step
+    y = timings.cells_per_gpu / avg_time_step
 
     ax.plot(x, y, '--', c=color, marker=marker_style, markersize=marker_size, label=label)
     return ax, x, y
@@ -337,24 +362,24 @@ def strong_scaling(data_path):
 
     # get header info
     with open(file_path, 'r') as file:
-        lines        = file.readlines()
-        header       = lines[5][1:].split()
+        header = next(itertools.islice(file, 5, 6))[1:].split()
 
-    scaling_data = pd.read_csv(file_path, delim_whitespace=True, comment='#', skiprows=4, names=header)
+    # Parse the data lines directly into an array, one row per run
+    scaling_data = np.loadtxt(file_path, comments='#', skiprows=4, ndmin=2)
+    total_time   = scaling_data[:, header.index('Total')]
 
     # Compute the speed up and strong scaling efficiency
-    num_ranks  = np.array(scaling_data['n_proc'])
-    speedup    = np.array(np.max(scaling_data['Total'])/scaling_data['Total'])
+    num_ranks  = scaling_data[:, header.index('n_proc')]
+    speedup    = np.max(total_time) / total_time
     efficiency = 100*(speedup / num_ranks)
 
     # Print the performance results
-    for i in range(len(speedup)):
-        print(f'Ranks: {int(num_ranks[i]):5d}, speedup: {round(speedup[i],2):>3.2f}, Strong Scaling Efficiency: {round(efficiency[i],2):3.2f}%')
+    print('\n'.join(f'Ranks: {int(ranks):5d}, speedup: {round(ranks_speedup,2):>3.2f}, Strong Scaling Efficiency: {round(ranks_efficiency,2):3.2f}%'
+                    for ranks, ranks_speedup, ranks_efficiency in zip(num_ranks, speedup, efficiency)))
 
     # ===== Speedup Plot =====
     # Instantiate Plot
-    fig = plt.figure(1, figsize=(shared_tools.fig_height, shared_tools.fig_height))
-    ax = plt.gca()
+    fig, ax = plt.subplots(figsize=(shared_tools.fig_height, shared_tools.fig_height))
 
     # Set plot settings
     color_total        = 'black'#'#D55E00'
@@ -384,13 +409,12 @@ def strong_scaling(data_path):
     fig.tight_layout()
 
     output_path = shared_tools.repo_root / 'latex-src' / f'scaling_test_strong_speedup.pdf'
-    fig.savefig(output_path, dpi=400)
-    plt.close('all')
+    fig.savefig(output_path)
+    plt.close(fig)
 
     # ===== Strong Scaling Efficiency Plot =====
     # Instantiate Plot
-    fig = plt.figure(2, figsize=(shared_tools.fig_height, shared_tools.fig_height))
-    ax = plt.gca()
+    fig, ax = plt.subplots(figsize=(shared_tools.fig_height, shared_tools.fig_height))
 
     # Set plot settings
     color_total        = 'black'#'#D55E00'
@@ -429,7 +453,8 @@ def strong_scaling(data_path):
     fig.tight_layout()
 
     output_path = shared_tools.repo_root / 'latex-src' / f'scaling_test_strong_efficiency.pdf'
-    fig.savefig(output_path, dpi=400)
+    fig.savefig(output_path)
+    plt.close(fig)
 # ==============================================================================
 
 if __name__ == '__main__':
@@ -7,11 +7,19 @@
 ================================================================================
 """
 
+import contextlib
+import fcntl
+import functools
+import json
+import os
 import pathlib
 import pickle
 import subprocess
-import os
+import shlex
+import shutil
+import tempfile
 import h5py
+import numba
 import numpy as np
 
 # ==============================================================================
@@ -21,12 +29,30 @@ import numpy as np
 # Repo Root Path
 repo_root = pathlib.Path(__file__).resolve().parent.parent
 
-# The path to the pickled dictionary
-pickle_filepath = repo_root / 'python' / 'links.pkl'
+# The path to the JSON file with the links to the script that made each plot
+links_filepath = repo_root / 'python' / 'links.json'
 
 # Path to data files
 data_files_path = repo_root / 'data'
 
+# The size of the HDF5 chunk cache, in bytes, to use when reading data files
+hdf5_chunk_cache_size = 256 * 1024 * 1024
+
+# The number of slots in the HDF5 chunk cache hash table. This should be a prime
+# much larger than the number of chunks that fit in the cache to avoid chunks
+# evicting each other on hash collisions
+hdf5_chunk_cache_slots = 1_000_003
+
+# The reconstructors that there are Cholla executables for
+cholla_reconstructors = frozenset(['ppmc', 'plmc'])
+
+# The names of the conserved variable datasets in the Cholla HDF5 files
+hdf5_conserved_fields = ['density', 'Energy', 'momentum_x', 'momentum_y', 'momentum_z',
+                         'magnetic_x', 'magnetic_y', 'magnetic_z']
+
+# The keys of the data dictionaries that hold metadata rather than fields
+metadata_keys = frozenset(['resolution', 'gamma', 'time', 'dx'])
+
 # The root GitHub URL
 github_url_root = 'https://github.com/bcaddy/caddy-et-al-2023/blob'
 
@@ -84,7 +110,9 @@ def cholla_runner(exe_path: pathlib.Path = repo_root / 'cholla' / 'bin',
                   move_initial: bool = False,
                   move_final: bool = False,
                   initial_filename: str = 'initial',
-                  final_filename: str = 'final') -> None:
+                  final_filename: str = 'final',
+                  snapshot_prefix: str = None,
+                  run_dir: pathlib.Path = None) -> None:
     """Run cholla with the given parameters and organize/clear the resulting files
 
     Args:
@@ -96,38 +124,101 @@ def cholla_runner(exe_path: pathlib.Path = repo_root / 'cholla' / 'bin',
         move_final (bool, optional): If True move the final conditions file, if false delete it.. Defaults to False.
         initial_filename (str, optional): The new name of the initial conditions file. Defaults to 'initial'.
         final_filename (str, optional): The new name of the final conditions file. Defaults to 'final'.
+        snapshot_prefix (str, optional): If given then every other snapshot, N.h5.0, is moved to {snapshot_prefix}_N.h5. Defaults to None, which deletes them.
+        run_dir (pathlib.Path, optional): The directory to run Cholla in, this is where Cholla will write its output. Defaults to None, which runs in a new scratch directory so that concurrent runs don't clobber each other's output files.
     """
 
-    if not (reconstructor == 'ppmc' or reconstructor == 'plmc'):
-        raise ValueError("reconstructor argument can only be 'ppmc' or 'plmc'")
+    if reconstructor not in cholla_reconstructors:
+        raise ValueError(f'reconstructor argument can only be one of {sorted(cholla_reconstructors)}')
 
     # Generate Cholla run command
     cholla_path = exe_path / f'cholla.mhd.c3po.{reconstructor}'
     param_file_path = repo_root / 'python' / 'cholla-config-files' / param_file_name
     log_file = repo_root / 'cholla.log'
 
-    command = f'{cholla_path} {param_file_path} {cholla_cli_args} >> {log_file} 2>&1'
+    command = [str(cholla_path), str(param_file_path)] + shlex.split(cholla_cli_args)
+
+    def move(source, destination):
+        # Overwrite atomically when possible, otherwise copy across filesystems
+        try:
+            os.replace(source, destination)
+        except OSError:
+            shutil.move(source, destination)
+
+    with contextlib.ExitStack() as stack:
+        if run_dir is None:
+            run_dir = pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory(dir=data_files_path)))
+
+        # Run Cholla, appending all of its output to the log file. A failed run
+        # raises here rather than later when its output files are missing
+        with open(log_file, 'ab') as log:
+            subprocess.run(command, cwd=run_dir, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+        # Move or delete data files
+        initial_data = run_dir / '0.h5.0'
+        final_data = run_dir / '1.h5.0'
+
+        if move_initial:
+            move(initial_data, data_files_path / f'{initial_filename}.h5')
+        else:
+            initial_data.unlink(missing_ok=True)
+
+        if move_final:
+            move(final_data, data_files_path / f'{final_filename}.h5')
+        else:
+            final_data.unlink(missing_ok=True)
+
+        # Move or delete the rest of the snapshots in one pass over the directory
+        with os.scandir(run_dir) as entries:
+            for entry in entries:
+                if '.h5.' not in entry.name:
+                    continue
+                if snapshot_prefix is None:
+                    os.unlink(entry.path)
+                else:
+                    move(entry.path, data_files_path / f'{snapshot_prefix}_{entry.name.rpartition(".")[0]}')
+
+        for log_name in ['run_output.log', 'run_timing.log']:
+            (run_dir / log_name).unlink(missing_ok=True)
+# ==============================================================================
+
+# ==============================================================================
+def max_concurrent_workers(num_tasks: int, max_workers: int = None) -> int:
+    """Choose the number of workers for a pool that runs independent tasks
+
+    Args:
+        num_tasks (int): The number of tasks that will be run
+        max_workers (int, optional): The number of workers requested by the user. Defaults to None, which is one worker per task limited by the number of CPUs.
 
-    # Run Cholla
-    os.system(command)
+    Returns:
+        int: The number of workers to use, always at least one
+    """
+    if max_workers is not None:
+        return max_workers
+
+    # os.cpu_count() returns None if the number of CPUs can't be determined
+    return max(1, min(num_tasks, os.cpu_count() or 1))
+# ==============================================================================
 
-    # Move or delete data files
-    data_source_dir = repo_root / 'python'
-    initial_data = data_source_dir / '0.h5.0'
-    final_data = data_source_dir / '1.h5.0'
+# ==============================================================================
+def apply_paper_style():
+    """Set up matplotlib with the Agg backend and the fonts used by every figure
+    in the paper. matplotlib is imported here so that scripts only pay for the
+    import when plotting
 
-    if move_initial:
-        initial_data.rename(data_files_path / f'{initial_filename}.h5')
-    else:
-        initial_data.unlink()
+    Returns:
+        module: matplotlib.pyplot
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
 
-    if move_final:
-        final_data.rename(data_files_path / f'{final_filename}.h5')
-    else:
-        final_data.unlink()
+    matplotlib.rcParams['font.sans-serif'] = "Helvetica"
+    matplotlib.rcParams['font.family'] = "sans-serif"
+    matplotlib.rcParams['mathtext.fontset'] = 'cm'
+    matplotlib.rcParams['mathtext.rm'] = 'serif'
 
-    (data_source_dir / 'run_output.log').unlink()
-    (data_source_dir / 'run_timing.log').unlink()
+    return plt
 # ==============================================================================
 
 # ==============================================================================
@@ -139,7 +230,9 @@ def load_conserved_data(file_name: str,
                         load_gamma: bool = False,
                         load_resolution: bool = False,
                         load_time: bool = False,
-                        load_dx: bool = False) -> dict:
+                        load_dx: bool = False,
+                        memory_map: bool = False,
+                        dtype: type = np.float64) -> dict:
     """Load the conserved variables from the HDF5 file
 
     Args:
@@ -148,34 +241,259 @@ def load_conserved_data(file_name: str,
         load_resolution (bool, optional): Whether or not to load the resolution. Defaults to False.
         load_time (bool, optional): Whether or not to load the time of the snapshot. Defaults to False.
         load_dx (bool, optional): Whether or not to load the dx, dy, dz of the snapshot. Defaults to False.
+        memory_map (bool, optional): Whether or not to memory map the fields instead of reading them into memory. Only
+            contiguous datasets that are already of type dtype can be memory mapped, any others are still read. Defaults to False.
+        dtype (type, optional): The data type to load the fields as. Lower precision types like np.float32 are fine
+            for plotting and halve the memory traffic of everything computed from the fields. Defaults to np.float64.
 
     Returns:
         dict: The dictionary containing all the conserved data
     """
-    file = h5py.File(data_files_path / f'{file_name}.h5', 'r')
-
-    output = {}
-    if load_resolution:
-        output['resolution'] = file.attrs['dims']
-    if load_gamma:
-        output['gamma']      = file.attrs['gamma']
-    if load_time:
-        output['time']       = file.attrs['t']
-    if load_dx:
-        output['dx']         = file.attrs['dx']
-
-    output['density']    = np.array(file['density'])
-    output['energy']     = np.array(file['Energy'])
-    output['momentum_x'] = np.array(file['momentum_x'])
-    output['momentum_y'] = np.array(file['momentum_y'])
-    output['momentum_z'] = np.array(file['momentum_z'])
-    output['magnetic_x'] = np.array(file['magnetic_x'])
-    output['magnetic_y'] = np.array(file['magnetic_y'])
-    output['magnetic_z'] = np.array(file['magnetic_z'])
+    def load(dataset):
+        if memory_map and dataset.dtype == dtype:
+            mapped = memory_map_dataset(dataset)
+            if mapped is not None:
+                return mapped
+        return dataset.astype(dtype)[...]
+
+    with h5py.File(data_files_path / f'{file_name}.h5', 'r', rdcc_nbytes=hdf5_chunk_cache_size, rdcc_nslots=hdf5_chunk_cache_slots) as file:
+        output = {}
+        if load_resolution:
+            output['resolution'] = file.attrs['dims']
+        if load_gamma:
+            output['gamma']      = file.attrs['gamma']
+        if load_time:
+            output['time']       = file.attrs['t']
+        if load_dx:
+            output['dx']         = file.attrs['dx']
+
+        output['density']    = load(file['density'])
+        output['energy']     = load(file['Energy'])
+        output['momentum_x'] = load(file['momentum_x'])
+        output['momentum_y'] = load(file['momentum_y'])
+        output['momentum_z'] = load(file['momentum_z'])
+        output['magnetic_x'] = load(file['magnetic_x'])
+        output['magnetic_y'] = load(file['magnetic_y'])
+        output['magnetic_z'] = load(file['magnetic_z'])
+
+    return output
+# ==============================================================================
+
+# ==============================================================================
+def load_conserved_slice(file_name: str,
+                         z_slice_loc: int = None,
+                         load_gamma: bool = False,
+                         load_resolution: bool = False) -> dict:
+    """Load a single z slice of the conserved variables from the HDF5 file and
+    compute the centered magnetic fields on that slice. Only the slice is read
+    from the file.
+
+    Args:
+        file_name (str): The name of the HDF5 file, no extension
+        z_slice_loc (int, optional): The z location to slice at. Defaults to None, which is the middle of the grid.
+        load_gamma (bool, optional): Whether or not to load gamma. Defaults to False.
+        load_resolution (bool, optional): Whether or not to load the resolution. Defaults to False.
+
+    Returns:
+        dict: The dictionary containing the sliced conserved data and centered magnetic fields
+    """
+    with h5py.File(data_files_path / f'{file_name}.h5', 'r', rdcc_nbytes=hdf5_chunk_cache_size, rdcc_nslots=hdf5_chunk_cache_slots) as file:
+        if z_slice_loc is None:
+            z_slice_loc = file.attrs['dims'][2] // 2
+
+        output = {}
+        if load_resolution:
+            output['resolution'] = file.attrs['dims']
+        if load_gamma:
+            output['gamma']      = file.attrs['gamma']
+
+        # The cell centered fields and the two magnetic_z faces around the slice
+        # all have the same shape, read them directly into one contiguous
+        # buffer. The returned fields are views into it
+        cell_fields = {'density':'density', 'energy':'Energy', 'momentum_x':'momentum_x',
+                       'momentum_y':'momentum_y', 'momentum_z':'momentum_z'}
+        density     = file['density']
+        buffer      = np.empty((len(cell_fields) + 2, *density.shape[:2]), dtype=density.dtype)
+        for i, (name, dataset_name) in enumerate(cell_fields.items()):
+            file[dataset_name].read_direct(buffer[i], np.s_[:, :, z_slice_loc])
+            output[name] = buffer[i]
+        file['magnetic_z'].read_direct(buffer[-2], np.s_[:, :, z_slice_loc])
+        file['magnetic_z'].read_direct(buffer[-1], np.s_[:, :, z_slice_loc+1])
+
+        output['magnetic_x'] = file['magnetic_x'][:, :, z_slice_loc]
+        output['magnetic_y'] = file['magnetic_y'][:, :, z_slice_loc]
+
+    output['magnetic_z'] = buffer[-2]
+
+    # Center the magnetic fields on the slice
+    output['magnetic_x_centered'] = np.add(output['magnetic_x'][1:], output['magnetic_x'][:-1])
+    output['magnetic_y_centered'] = np.add(output['magnetic_y'][:, 1:], output['magnetic_y'][:, :-1])
+    output['magnetic_z_centered'] = np.add(buffer[-1], buffer[-2])
+    for field in ['magnetic_x_centered', 'magnetic_y_centered', 'magnetic_z_centered']:
+        output[field] *= 0.5
+
+    return output
+# ==============================================================================
+
+# ==============================================================================
+def load_conserved_line(file_name: str,
+                        y_slice_loc: int = None,
+                        z_slice_loc: int = None,
+                        load_gamma: bool = False,
+                        load_resolution: bool = False,
+                        dtype: type = np.float64) -> dict:
+    """Load a single line along the x direction of the conserved variables from
+    the HDF5 file and compute the centered magnetic fields on that line. Only
+    the line, and the magnetic faces around it, are read from the file.
+
+    Args:
+        file_name (str): The name of the HDF5 file, no extension
+        y_slice_loc (int, optional): The y location of the line. Defaults to None, which is the middle of the grid.
+        z_slice_loc (int, optional): The z location of the line. Defaults to None, which is the middle of the grid.
+        load_gamma (bool, optional): Whether or not to load gamma. Defaults to False.
+        load_resolution (bool, optional): Whether or not to load the resolution. Defaults to False.
+        dtype (type, optional): The data type to load the fields as. Defaults to np.float64.
+
+    Returns:
+        dict: The dictionary containing the conserved data and centered magnetic fields along the line
+    """
+    with h5py.File(data_files_path / f'{file_name}.h5', 'r', rdcc_nbytes=hdf5_chunk_cache_size, rdcc_nslots=hdf5_chunk_cache_slots) as file:
+        dims = file.attrs['dims']
+        if y_slice_loc is None:
+            y_slice_loc = dims[1] // 2
+        if z_slice_loc is None:
+            z_slice_loc = dims[2] // 2
+
+        output = {}
+        if load_resolution:
+            output['resolution'] = dims
+        if load_gamma:
+            output['gamma']      = file.attrs['gamma']
+
+        # The cell centered fields all have the same length, read them directly
+        # into one contiguous buffer. The returned fields are views into it
+        cell_fields = {'density':'density', 'energy':'Energy', 'momentum_x':'momentum_x',
+                       'momentum_y':'momentum_y', 'momentum_z':'momentum_z'}
+        buffer      = np.empty((len(cell_fields), dims[0]), dtype=dtype)
+        for i, (name, dataset_name) in enumerate(cell_fields.items()):
+            file[dataset_name].read_direct(buffer[i], np.s_[:, y_slice_loc, z_slice_loc])
+            output[name] = buffer[i]
+
+        # Read the faces on either side of the line with a single selection
+        # each. The two magnetic_z faces are adjacent in the file so this is
+        # one small contiguous read per x position rather than two
+        faces = np.empty((2, dims[0], 2), dtype=dtype)
+        file['magnetic_y'].read_direct(faces[0], np.s_[:, y_slice_loc:y_slice_loc+2, z_slice_loc])
+        file['magnetic_z'].read_direct(faces[1], np.s_[:, y_slice_loc, z_slice_loc:z_slice_loc+2])
+
+        output['magnetic_x'] = np.empty(dims[0] + 1, dtype=dtype)
+        file['magnetic_x'].read_direct(output['magnetic_x'], np.s_[:, y_slice_loc, z_slice_loc])
+
+    output['magnetic_y'] = faces[0, :, 0]
+    output['magnetic_z'] = faces[1, :, 0]
+
+    # Center the magnetic fields on the line
+    output['magnetic_x_centered'] = np.add(output['magnetic_x'][1:], output['magnetic_x'][:-1])
+    output['magnetic_y_centered'] = np.add(faces[0, :, 0], faces[0, :, 1])
+    output['magnetic_z_centered'] = np.add(faces[1, :, 0], faces[1, :, 1])
+    for field in ['magnetic_x_centered', 'magnetic_y_centered', 'magnetic_z_centered']:
+        output[field] *= 0.5
+
+    return output
+# ==============================================================================
+
+# ==============================================================================
+def load_magnetic_data(file_name: str, buffers: dict = None) -> dict:
+    """Load only the magnetic fields, time, and cell size from the HDF5 file
+
+    Args:
+        file_name (str): The name of the HDF5 file, no extension
+        buffers (dict, optional): Preallocated arrays, keyed by field name, to read the magnetic fields into. Defaults to None, which allocates new arrays.
+
+    Returns:
+        dict: The dictionary containing the magnetic fields, time, and dx
+    """
+    with h5py.File(data_files_path / f'{file_name}.h5', 'r', rdcc_nbytes=hdf5_chunk_cache_size, rdcc_nslots=hdf5_chunk_cache_slots) as file:
+        output = {}
+        output['time'] = file.attrs['t']
+        output['dx']   = file.attrs['dx']
+
+        for field in ['magnetic_x', 'magnetic_y', 'magnetic_z']:
+            if buffers is not None:
+                output[field] = read_dataset_into(file[field], buffers[field])
+            else:
+                output[field] = file[field][...]
 
     return output
 # ==============================================================================
 
+# ==============================================================================
+def read_dataset_into(dataset: h5py.Dataset, buffer: np.ndarray) -> np.ndarray:
+    """Read an entire dataset into a preallocated, C contiguous array through
+    h5py's low level interface. This skips the selection and type checking
+    machinery of h5py's high level reading methods
+
+    Args:
+        dataset (h5py.Dataset): The dataset to read
+        buffer (np.ndarray): The array to read into, must be the same shape as the dataset
+
+    Returns:
+        np.ndarray: The buffer, now containing the dataset
+    """
+    dataset.id.read(h5py.h5s.ALL, h5py.h5s.ALL, buffer)
+    return buffer
+# ==============================================================================
+
+# ==============================================================================
+def memory_map_dataset(dataset: h5py.Dataset) -> np.memmap:
+    """Memory map a dataset directly from the HDF5 file, bypassing HDF5
+    entirely. This only works for contiguous datasets, chunked or compressed
+    datasets don't have a single offset in the file.
+
+    Args:
+        dataset (h5py.Dataset): The dataset to memory map
+
+    Returns:
+        np.memmap: A read only memory map of the dataset or None if the dataset isn't contiguous
+    """
+    # Only query the low level dataset for its layout, offset, and type once
+    dataset_id = dataset.id
+    if dataset_id.get_create_plist().get_layout() != h5py.h5d.CONTIGUOUS:
+        return None
+    offset = dataset_id.get_offset()
+    if offset is None:
+        return None
+
+    return np.memmap(dataset.file.filename, dtype=dataset_id.dtype, mode='r', offset=offset, shape=dataset_id.shape)
+# ==============================================================================
+
+# ==============================================================================
+def datasets_in_file_order(file: h5py.File, names: list = hdf5_conserved_fields) -> list:
+    """Find the requested datasets in an open HDF5 file in a single pass and
+    sort them by their offset in the file so that reading them in order is
+    sequential on disk
+
+    Args:
+        file (h5py.File): The open HDF5 file
+        names (list, optional): The names of the datasets to find. Defaults to hdf5_conserved_fields.
+
+    Returns:
+        list: (name, h5py.Dataset) pairs sorted by their offset in the file
+    """
+    datasets = []
+
+    def collect(name, item):
+        if isinstance(item, h5py.Dataset) and name in names:
+            # Chunked or unallocated datasets don't have an offset, put them last
+            offset = item.id.get_offset()
+            datasets.append((np.inf if offset is None else offset, name, item))
+
+    file.visititems(collect)
+    datasets.sort(key=lambda dataset: dataset[0])
+
+    return [(name, item) for _, name, item in datasets]
+# ==============================================================================
+
 # ==============================================================================
 def center_magnetic_fields(data: dict) -> dict:
     """Compute the centered magnetic fields
@@ -186,16 +504,27 @@ def center_magnetic_fields(data: dict) -> dict:
     Returns:
         dict: The input data with new centered magnetic field data
     """
-    data['magnetic_x_centered'] = 0.5 * (data['magnetic_x'][1:, :, :]
-                                         + data['magnetic_x'][:-1, :, :])
-    data['magnetic_y_centered'] = 0.5 * (data['magnetic_y'][:, 1:, :]
-                                         + data['magnetic_y'][:, :-1, :])
-    data['magnetic_z_centered'] = 0.5 * (data['magnetic_z'][:, :, 1:]
-                                         + data['magnetic_z'][:, :, :-1])
+    # Average the faces in a single pass, writing straight into the output
+    for axis, field in enumerate(['magnetic_x', 'magnetic_y', 'magnetic_z']):
+        offset = np.zeros(3, dtype=np.int64)
+        offset[axis] = 1
+
+        centered = np.empty(np.shape(data[field]) - offset, dtype=data[field].dtype)
+        _center_faces_kernel(data[field], offset[0], offset[1], offset[2], centered)
+        data[f'{field}_centered'] = centered
 
     return data
 # ==============================================================================
 
+# ==============================================================================
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _center_faces_kernel(faces, di, dj, dk, out):
+    for i in numba.prange(out.shape[0]):
+        for j in range(out.shape[1]):
+            for k in range(out.shape[2]):
+                out[i, j, k] = 0.5 * (faces[i, j, k] + faces[i+di, j+dj, k+dk])
+# ==============================================================================
+
 # ==============================================================================
 def slice_data(data: dict,
                x_slice_loc: int = None,
@@ -212,45 +541,40 @@ def slice_data(data: dict,
     Returns:
         dict: The sliced data
     """
+    # Build the slice once and apply it to every field
+    slices = tuple(slice(None) if slice_loc is None else slice(slice_loc, slice_loc+1)
+                   for slice_loc in (x_slice_loc, y_slice_loc, z_slice_loc))
 
-    def limits(slice_loc, slice_dir, field):
-        if slice_loc == None:
-            low_lim = 0
-            high_lim = field.shape[slice_dir]
-        else:
-            low_lim = slice_loc
-            high_lim = low_lim+1
-        return low_lim, high_lim
-
-    for key in data:
-        if key in ['resolution', 'gamma']:
+    for key, field in data.items():
+        if key in metadata_keys:
             continue
 
-        field = data[key]
-
-        x_low, x_high = limits(x_slice_loc, 0, field)
-        y_low, y_high = limits(y_slice_loc, 1, field)
-        z_low, z_high = limits(z_slice_loc, 2, field)
-
-        data[key] = data[key][x_low:x_high, y_low:y_high, z_low:z_high]
-        data[key] = data[key].squeeze() # remove all dimensions of size 1
+        data[key] = field[slices].squeeze() # remove all dimensions of size 1
 
     return data
 # ==============================================================================
 
 # ==============================================================================
-def compute_velocities(data: dict) -> dict:
+def compute_velocities(data: dict, inplace: bool = False) -> dict:
     """Compute the velocities and add them to the data dictionary
 
     Args:
         data (dict): All the input data
+        inplace (bool, optional): If True then the momentum fields are overwritten with, and replaced by, the
+            velocities instead of allocating new arrays. Defaults to False.
 
     Returns:
         dict: The input data with new velocities fields
     """
-    data['velocity_x'] = data['momentum_x'] / data['density']
-    data['velocity_y'] = data['momentum_y'] / data['density']
-    data['velocity_z'] = data['momentum_z'] / data['density']
+    # Divide once and multiply by the inverse density for each component
+    inverse_density = np.reciprocal(data['density'])
+
+    for direction in ['x', 'y', 'z']:
+        if inplace:
+            momentum = data.pop(f'momentum_{direction}')
+            data[f'velocity_{direction}'] = np.multiply(momentum, inverse_density, out=momentum)
+        else:
+            data[f'velocity_{direction}'] = data[f'momentum_{direction}'] * inverse_density
 
     return data
 # ==============================================================================
@@ -268,62 +592,202 @@ def compute_derived_quantities(data: dict, gamma: float) -> dict:
     Returns:
         dict: The input data with new derived quantities fields
     """
+    # Compute every quantity in a single fused pass over the data rather than
+    # streaming the full arrays through memory once per numpy operation
+    shape = np.shape(data['velocity_x'])
+    dtype = np.result_type(data['velocity_x'], data['magnetic_x_centered'])
+    for field in ['spec_kinetic', 'magnetic_energy', 'gas_pressure', 'total_pressure']:
+        data[field] = np.empty(shape, dtype=dtype)
+
+    _derived_quantities_kernel(*[np.ravel(data[field]) for field in ['velocity_x',
+                                                                     'velocity_y',
+                                                                     'velocity_z',
+                                                                     'magnetic_x_centered',
+                                                                     'magnetic_y_centered',
+                                                                     'magnetic_z_centered',
+                                                                     'density',
+                                                                     'energy',
+                                                                     'spec_kinetic',
+                                                                     'magnetic_energy',
+                                                                     'gas_pressure',
+                                                                     'total_pressure']],
+                               np.asarray(gamma).item())
 
-    data['spec_kinetic']    = 0.5 * (data['velocity_x']**2 + data['velocity_y']**2 + data['velocity_z']**2)
-    data['magnetic_energy'] = 0.5 * (data['magnetic_x_centered']**2 + data['magnetic_y_centered']**2 + data['magnetic_z_centered']**2)
+    return data
+# ==============================================================================
 
-    data['gas_pressure'] = (gamma - 1) * (data['energy'] - data['density'] * data['spec_kinetic'] - data['magnetic_energy'])
-    data['total_pressure'] = data['gas_pressure'] + data['magnetic_energy']
+# ==============================================================================
+@numba.njit(fastmath=True, nogil=True, cache=True)
+def _derived_quantities_kernel(velocity_x, velocity_y, velocity_z,
+                               magnetic_x, magnetic_y, magnetic_z,
+                               density, energy,
+                               spec_kinetic, magnetic_energy, gas_pressure, total_pressure,
+                               gamma):
+    for i in range(density.size):
+        spec_kinetic[i]    = 0.5 * (velocity_x[i]**2 + velocity_y[i]**2 + velocity_z[i]**2)
+        magnetic_energy[i] = 0.5 * (magnetic_x[i]**2 + magnetic_y[i]**2 + magnetic_z[i]**2)
+        gas_pressure[i]    = (gamma - 1) * (energy[i] - density[i] * spec_kinetic[i] - magnetic_energy[i])
+        total_pressure[i]  = gas_pressure[i] + magnetic_energy[i]
+# ==============================================================================
 
-    return data
+# ==============================================================================
+@numba.njit(fastmath=True, nogil=True, cache=True)
+def l1_error(initial: np.ndarray, final: np.ndarray) -> float:
+    """Compute the L1 error between two 1D arrays in a single pass
+
+    Args:
+        initial (np.ndarray): The initial data
+        final (np.ndarray): The final data
+
+    Returns:
+        float: The mean absolute difference between the two arrays
+    """
+    total = 0.0
+    for i in range(initial.size):
+        total += abs(initial[i] - final[i])
+
+    return total / initial.size
+# ==============================================================================
+
+# ==============================================================================
+def compute_l2_norm(initial_file_name: str, final_file_name: str, buffers: dict = None) -> float:
+    """Compute the L2 norm of the L1 errors of every conserved field between two
+    snapshots. Contiguous datasets are memory mapped so that they're streamed
+    from disk as the L1 errors are computed, anything else is read into memory
+
+    Args:
+        initial_file_name (str): The name of the initial HDF5 file, no extension
+        final_file_name (str): The name of the final HDF5 file, no extension
+        buffers (dict, optional): Pairs of arrays, keyed by shape and type, to read the datasets that can't be memory mapped into. Missing pairs are added to it so it can be reused across calls. Defaults to None, which allocates new arrays for each call.
+
+    Returns:
+        float: The L2 norm of the L1 errors
+    """
+    if buffers is None:
+        buffers = {}
+
+    L2Norm = 0.0
+    with h5py.File(data_files_path / f'{initial_file_name}.h5', 'r', rdcc_nbytes=hdf5_chunk_cache_size, rdcc_nslots=hdf5_chunk_cache_slots) as initial_file, \
+         h5py.File(data_files_path / f'{final_file_name}.h5',   'r', rdcc_nbytes=hdf5_chunk_cache_size, rdcc_nslots=hdf5_chunk_cache_slots) as final_file:
+        for field, initial_dataset in datasets_in_file_order(initial_file):
+            final_dataset = final_file[field]
+
+            initial_field = memory_map_dataset(initial_dataset)
+            final_field   = memory_map_dataset(final_dataset)
+
+            if initial_field is None or final_field is None:
+                key = (initial_dataset.shape, initial_dataset.dtype)
+                if key not in buffers:
+                    buffers[key] = (np.empty(*key), np.empty(*key))
+                initial_field, final_field = buffers[key]
+
+                read_dataset_into(initial_dataset, initial_field)
+                read_dataset_into(final_dataset, final_field)
+
+            L1Error = l1_error(initial_field.ravel(), final_field.ravel())
+            L2Norm += L1Error * L1Error
+
+    return np.sqrt(L2Norm)
+# ==============================================================================
+
+# ==============================================================================
+def is_up_to_date(output_path: pathlib.Path, input_paths) -> bool:
+    """Check if a file generated from other files is newer than all of them
+
+    Args:
+        output_path (pathlib.Path): The path to the generated file
+        input_paths (iterable of pathlib.Path): The paths to the files used to generate output_path
+
+    Returns:
+        bool: True if output_path exists and is newer than every input, False otherwise
+    """
+    if not output_path.exists():
+        return False
+
+    output_mtime = output_path.stat().st_mtime
+    return all(path.stat().st_mtime <= output_mtime for path in input_paths)
 # ==============================================================================
 
 # ==============================================================================
 # This next section is all the functions for pickling and unpickling the
 # dictionary that is used in the LaTeX for links
 # ==============================================================================
-def pickle_dictionary(dictionary: dict, path: pathlib.Path = pickle_filepath) -> None:
+def pickle_dictionary(dictionary: dict, path: pathlib.Path) -> None:
     """Save a dictionary to a Pickle file
 
     Args:
         dictionary (dict): The dictionary to save
-        path (pathlib.Path, optional): The path to the pickle file. Defaults to pickle_filepath.
+        path (pathlib.Path): The path to the pickle file
     """
     with open(path, 'wb') as file:
-        pickle.dump(dictionary, file)
+        pickle.dump(dictionary, file, protocol=pickle.HIGHEST_PROTOCOL)
 # ==============================================================================
 
 # ==============================================================================
-def unpickle_dictionary(path: pathlib.Path = pickle_filepath) -> dict:
+def unpickle_dictionary(path: pathlib.Path) -> dict:
     """Unpickle a pickled dictionary
 
     Args:
-        path (pathlib.Path, optional): The path to the dictionary to unpickle. Defaults to pickle_filepath.
+        path (pathlib.Path): The path to the dictionary to unpickle
 
     Returns:
         dict: The dictionary that was unpickled
     """
-    if path.exists():
+    try:
         with open(path, 'rb') as file:
             return pickle.load(file)
-    else:
+    except FileNotFoundError:
         return {}
 # ==============================================================================
 
+# ==============================================================================
+@functools.lru_cache(maxsize=1)
+def current_commit_hash() -> str:
+    """Get the hash of the current git commit. The result is cached so git is
+    only run once per process
+
+    Returns:
+        str: The hash of the current commit
+    """
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+# ==============================================================================
+
 # ==============================================================================
 def update_plot_entry(key: str, script_name: str) -> None:
-    """Update the pickled dictionary used by LaTeX to show links.
+    """Update the dictionary of links used by LaTeX.
 
     Args:
         key (str): The key of the new or updated entry
         script_name (str): The value of the new or updated entry. Should be the name of the python script
     """
-    data = unpickle_dictionary()
+    update_plot_entries({key: script_name})
+# ==============================================================================
+
+# ==============================================================================
+def update_plot_entries(entries: dict) -> None:
+    """Update several entries in the dictionary of links used by LaTeX, reading
+    and writing the file only once
+
+    Args:
+        entries (dict): The keys of the new or updated entries mapped to the name of the python script that made them
+    """
+    if not entries:
+        return
+
+    commit_hash = current_commit_hash()
 
-    commit_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
-    link = f'{github_url_root}/{commit_hash}/{script_name}'
+    # Scripts can update their entries at the same time, e.g. from run-all.sh,
+    # so hold an exclusive lock on the file while reading and rewriting it to
+    # avoid losing another script's update
+    with open(links_filepath, 'a+') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        data = json.loads(file.read() or '{}')
 
-    data[key] = link
+        data.update({key: f'{github_url_root}/{commit_hash}/{script_name}' for key, script_name in entries.items()})
 
-    pickle_dictionary(data)
+        file.seek(0)
+        file.truncate()
+        json.dump(data, file, indent=4)
+        file.write('\n')
 # ==============================================================================
\ No newline at end of file
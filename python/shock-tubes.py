@@ -8,26 +8,24 @@
 """
 
 from timeit import default_timer
-import matplotlib
-import matplotlib.pyplot as plt
+import concurrent.futures
+import itertools
 import numpy as np
 import argparse
 import pathlib
 
 import shared_tools
 
-plt.close('all')
-
-matplotlib.rcParams['font.sans-serif'] = "Helvetica"
-matplotlib.rcParams['font.family'] = "sans-serif"
-matplotlib.rcParams['mathtext.fontset'] = 'cm'
-matplotlib.rcParams['mathtext.rm'] = 'serif'
-
 # Global Variables
 shock_tubes = ['b&w', 'd&w', 'rj1a', 'rj4d', 'einfeldt']
 resolution = {'nx':512, 'ny':16, 'nz':16}
 physical_size = 1.0
 
+# The fields to plot and the subplot each one goes in
+field_indices = {'density':(0,0), 'gas_pressure':(0,1), 'energy':(0,2),
+                 'velocity_x':(1,0), 'velocity_y':(1,1), 'velocity_z':(1,2),
+                 'magnetic_x':(2,0), 'magnetic_y':(2,1), 'magnetic_z':(2,2)}
+
 # Setup shock tube parameters
 shock_tube_params = {}
 coef = 1.0 / np.sqrt(4 * np.pi)
@@ -56,6 +54,8 @@ def main():
     parser.add_argument('-r', '--run_cholla', action="store_true", help='Runs cholla to generate all the data')
     parser.add_argument('-f', '--figure', action="store_true", help='Generate the plots')
     parser.add_argument('-t', '--tube', default=['all'], nargs='+', help="List of tubes to run and/or plot. Options are 'b&w', 'd&w', 'rj1a', 'rj4d', 'einfeldt', and 'all'")
+    parser.add_argument('--force', action="store_true", help='Regenerate every plot even if it is newer than its Cholla output')
+    parser.add_argument('-j', '--jobs', type=int, help='The maximum number of Cholla runs or plots to perform concurrently. Defaults to one per shock tube, limited by the number of CPUs')
 
     args = parser.parse_args()
 
@@ -77,35 +77,62 @@ def main():
         shock_tubes = args.tube
 
     if args.run_cholla:
-        runCholla()
+        runCholla(args.jobs)
 
     if args.figure:
-        plotShockTubes(rootPath, OutPath)
-        for tube in shock_tubes:
-            shared_tools.update_plot_entry(tube, 'python/shock-tubes.py')
+        plotted_tubes = plotShockTubes(rootPath, OutPath, args.jobs, force=args.force)
+        shared_tools.update_plot_entries({tube: 'python/shock-tubes.py' for tube in plotted_tubes})
 
 # ==============================================================================
 
 # ==============================================================================
-def runCholla():
+def runCholla(max_workers=None):
+    # Each shock tube is an independent run so launch them concurrently
+    max_workers = shared_tools.max_concurrent_workers(len(shock_tubes), max_workers)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_single_tube, shock_tubes))
+# ==============================================================================
+
+# ==============================================================================
+def run_single_tube(shock_tube):
     # Cholla settings
     common_settings = f"nx={resolution['nx']} ny={resolution['ny']} nz={resolution['nz']} init=Riemann " \
                       f"xmin=0.0 ymin=0.0 zmin=0.0 xlen={physical_size} ylen={physical_size} zlen={physical_size} "\
                        "xl_bcnd=3 xu_bcnd=3 yl_bcnd=3 yu_bcnd=3 zl_bcnd=3 zu_bcnd=3 "\
                        "outdir=./"
 
-    # Loop over the lists and run cholla for each combination
-    for shock_tube in shock_tubes:
-        shared_tools.cholla_runner(cholla_cli_args=f'{common_settings} {shock_tube_params[shock_tube]}',
-                                   move_final=True,
-                                   final_filename=f'{shock_tube}')
+    shared_tools.cholla_runner(cholla_cli_args=f'{common_settings} {shock_tube_params[shock_tube]}',
+                               move_final=True,
+                               final_filename=f'{shock_tube}')
 
-        # Print status
-        print(f'Finished with {shock_tube}')
+    # Print status
+    print(f'Finished with {shock_tube}')
 # ==============================================================================
 
 # ==============================================================================
-def plotShockTubes(rootPath, outPath):
+def plotShockTubes(rootPath, outPath, max_workers=None, force=False):
+    # Only plot the tubes whose data has changed since their plot was made
+    tubes = [shock_tube for shock_tube in shock_tubes
+             if force or not shared_tools.is_up_to_date(outPath / f'{shock_tube}.pdf',
+                                                        [shared_tools.data_files_path / f'{shock_tube}.h5'])]
+    if not tubes:
+        print('All shock tube plots are up to date.')
+        return tubes
+
+    # Each shock tube is its own figure so render them concurrently
+    max_workers = shared_tools.max_concurrent_workers(len(tubes), max_workers)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(plot_single_tube, tubes, itertools.repeat(outPath)))
+
+    return tubes
+# ==============================================================================
+
+# ==============================================================================
+def plot_single_tube(shock_tube, outPath):
+    plt = shared_tools.apply_paper_style()
+
     # Plotting info
     data_marker        = '.'
     data_markersize    = 5
@@ -113,72 +140,60 @@ def plotShockTubes(rootPath, outPath):
     linewidth          = 0.1 * data_markersize
     line_color         = 'black'
 
-    # Field info
-    fields = ['density', 'gas_pressure', 'energy', 'velocity_x', 'velocity_y', 'velocity_z',  'magnetic_x', 'magnetic_y', 'magnetic_z']
-    field_indices = {'density':(0,0), 'gas_pressure':(0,1), 'energy':(0,2),
-                     'velocity_x':(1,0), 'velocity_y':(1,1), 'velocity_z':(1,2),
-                     'magnetic_x':(2,0), 'magnetic_y':(2,1), 'magnetic_z':(2,2)}
-
-    # Plot the shock tubes data
-    for shock_tube in shock_tubes:
-        # Setup figure
-        fig, subPlot = plt.subplots(3, 3, figsize = (3*shared_tools.fig_width, 3*shared_tools.fig_height))
-
-        # Load data
-        data = shared_tools.load_conserved_data(f'{shock_tube}', load_gamma=True, load_resolution=True)
-        data = shared_tools.center_magnetic_fields(data)
-        data = shared_tools.slice_data(data,
-                                       y_slice_loc=data['resolution'][1]//2,
-                                       z_slice_loc=data['resolution'][2]//2)
-        data = shared_tools.compute_velocities(data)
-        data = shared_tools.compute_derived_quantities(data, data['gamma'])
-
-        for field in fields:
-            # Get info for this field
-            subplot_idx = field_indices[field]
-            field_data  = data[field]
-
-            # Compute the positional data
-            positions = np.linspace(0, physical_size, data[field].size)
-
-            # Check the range. If it's just noise then set y-limits
-            if np.abs(field_data.max() - field_data.min()) < 1E-10:
-                mean = field_data.mean()
-                subPlot[subplot_idx].set_ylim(mean - 0.5, mean + 0.5)
-
-            # Plot the data
-            subPlot[subplot_idx].plot(positions,
-                                      field_data,
-                                      color      = line_color,
-                                      linestyle  = data_linestyle,
-                                      linewidth  = linewidth,
-                                      marker     = data_marker,
-                                      markersize = data_markersize,
-                                      label      = 'PLMC')
-
-            # Set ticks and grid
-            subPlot[subplot_idx].tick_params(axis='both',
-                                             direction='in',
-                                             which='both',
-                                             labelsize=1.5*shared_tools.tick_font_size,
-                                             bottom=True,
-                                             top=True,
-                                             left=True,
-                                             right=True)
-
-            subPlot[subplot_idx].set_box_aspect(1)
-
-            # Set titles
-            subPlot[subplot_idx].set_ylabel(f'{shared_tools.pretty_names[field]}', fontsize=1.5*shared_tools.font_size_normal)
-            if (subplot_idx[0] == 2):
-                subPlot[subplot_idx].set_xlabel('Position', fontsize=1.5*shared_tools.font_size_normal)
-
-        # Save the figure and close it
-        fig.tight_layout()
-        plt.savefig(outPath / f'{shock_tube}.pdf', transparent = True)
-        plt.close()
-
-        print(f'Finished with {shared_tools.pretty_names[shock_tube]} plot.')
+    # Setup figure
+    fig, subPlot = plt.subplots(3, 3, layout='constrained', figsize = (3*shared_tools.fig_width, 3*shared_tools.fig_height))
+
+    # Load the line through the middle of the tube, single precision is
+    # plenty for plotting
+    data = shared_tools.load_conserved_line(f'{shock_tube}', load_gamma=True, dtype=np.float32)
+    data = shared_tools.compute_velocities(data, inplace=True)
+    data = shared_tools.compute_derived_quantities(data, data['gamma'])
+
+    # Compute the positional data once for each length of field, the magnetic_x
+    # faces have one more point than the cell centered fields
+    positions = {size: np.linspace(0, physical_size, size) for size in {data[field].size for field in field_indices}}
+
+    for field, subplot_idx in field_indices.items():
+        # Get info for this field
+        field_data = data[field]
+
+        # Check the range. If it's just noise then set y-limits
+        if np.ptp(field_data) < 1E-10:
+            mean = field_data.mean()
+            subPlot[subplot_idx].set_ylim(mean - 0.5, mean + 0.5)
+
+        # Plot the data
+        subPlot[subplot_idx].plot(positions[field_data.size],
+                                  field_data,
+                                  color      = line_color,
+                                  linestyle  = data_linestyle,
+                                  linewidth  = linewidth,
+                                  marker     = data_marker,
+                                  markersize = data_markersize,
+                                  label      = 'PLMC')
+
+        # Set ticks and grid
+        subPlot[subplot_idx].tick_params(axis='both',
+                                         direction='in',
+                                         which='both',
+                                         labelsize=1.5*shared_tools.tick_font_size,
+                                         bottom=True,
+                                         top=True,
+                                         left=True,
+                                         right=True)
+
+        subPlot[subplot_idx].set_box_aspect(1)
+
+        # Set titles
+        subPlot[subplot_idx].set_ylabel(f'{shared_tools.pretty_names[field]}', fontsize=1.5*shared_tools.font_size_normal)
+        if (subplot_idx[0] == 2):
+            subPlot[subplot_idx].set_xlabel('Position', fontsize=1.5*shared_tools.font_size_normal)
+
+    # Save the figure and close it
+    fig.savefig(outPath / f'{shock_tube}.pdf', transparent = True)
+    plt.close(fig)
+
+    print(f'Finished with {shared_tools.pretty_names[shock_tube]} plot.')
 # ==============================================================================
 
 